@@ -0,0 +1,132 @@
+"""
+Offline Quantization of the U²-Net ONNX Model
+Produces an FP16 (default) or INT8 artifact for BackgroundRemover
+
+Run this once at build time, then point the service at the output with
+the U2NET_QUANTIZED_MODEL environment variable:
+
+    python quantize_model.py --input ~/.u2net/u2net.onnx --output u2net_fp16.onnx
+    python quantize_model.py --input ~/.u2net/u2net.onnx --output u2net_int8.onnx \
+        --mode int8 --calibration-dir sample_images/
+
+FP16 is the default: it is numerically safe for this CNN and roughly
+halves model size and inference time. INT8 static quantization shrinks
+the model further but occasionally regresses mask quality, so validate
+outputs before deploying an INT8 artifact.
+"""
+
+import argparse
+import glob
+import logging
+import os
+
+import numpy as np
+
+logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# U²-Net's fixed input resolution and ImageNet-style normalization (matches
+# what rembg applies before inference)
+INPUT_SIZE = 320
+MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+
+def _load_calibration_batch(image_path: str) -> np.ndarray:
+    """Load and preprocess one calibration image to a (1, 3, 320, 320) tensor"""
+    from PIL import Image
+
+    image = Image.open(image_path).convert('RGB')
+    image = image.resize((INPUT_SIZE, INPUT_SIZE), Image.Resampling.LANCZOS)
+    arr = np.asarray(image, dtype=np.float32) / 255.0
+    arr = (arr - MEAN) / STD
+    return arr.transpose(2, 0, 1)[np.newaxis, ...]
+
+
+def quantize_fp16(input_path: str, output_path: str) -> None:
+    """Convert model weights to FP16"""
+    import onnx
+    from onnxconverter_common import float16
+
+    model = onnx.load(input_path)
+    model_fp16 = float16.convert_float_to_float16(model, keep_io_types=True)
+    onnx.save(model_fp16, output_path)
+
+
+def quantize_int8(input_path: str, output_path: str, calibration_dir: str) -> None:
+    """Statically quantize the model to INT8 using sample images for calibration"""
+    from onnxruntime.quantization import (
+        CalibrationDataReader,
+        QuantFormat,
+        QuantType,
+        quant_pre_process,
+        quantize_static,
+    )
+
+    image_paths = sorted(
+        path
+        for pattern in ('*.png', '*.jpg', '*.jpeg')
+        for path in glob.glob(os.path.join(calibration_dir, pattern))
+    )
+    if not image_paths:
+        raise SystemExit(f"No calibration images found in {calibration_dir}")
+    logger.info("Calibrating with %d images", len(image_paths))
+
+    class ImageFolderReader(CalibrationDataReader):
+        def __init__(self, paths):
+            self._iter = iter(paths)
+
+        def get_next(self):
+            path = next(self._iter, None)
+            if path is None:
+                return None
+            return {"input.1": _load_calibration_batch(path)}
+
+    # Shape inference / preprocessing pass recommended before static quantization
+    preprocessed_path = output_path + ".infer.onnx"
+    quant_pre_process(input_path, preprocessed_path)
+
+    quantize_static(
+        preprocessed_path,
+        output_path,
+        calibration_data_reader=ImageFolderReader(image_paths),
+        quant_format=QuantFormat.QDQ,
+        weight_type=QuantType.QInt8,
+        activation_type=QuantType.QInt8,
+    )
+    os.remove(preprocessed_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize the U²-Net ONNX model")
+    parser.add_argument("--input", required=True, help="Path to u2net.onnx")
+    parser.add_argument("--output", required=True, help="Path for the quantized model")
+    parser.add_argument(
+        "--mode",
+        choices=["fp16", "int8"],
+        default="fp16",
+        help="Quantization mode (default: fp16)"
+    )
+    parser.add_argument(
+        "--calibration-dir",
+        help="Directory of sample images (required for int8)"
+    )
+    args = parser.parse_args()
+
+    if args.mode == "int8":
+        if not args.calibration_dir:
+            parser.error("--calibration-dir is required for int8 quantization")
+        quantize_int8(args.input, args.output, args.calibration_dir)
+    else:
+        quantize_fp16(args.input, args.output)
+
+    original_mb = os.path.getsize(args.input) / (1024 * 1024)
+    quantized_mb = os.path.getsize(args.output) / (1024 * 1024)
+    logger.info(
+        "Quantized model written to %s (%.1f MB -> %.1f MB)",
+        args.output, original_mb, quantized_mb
+    )
+
+
+if __name__ == "__main__":
+    main()